@@ -10,8 +10,8 @@ operator-pvc-manager expects two K8s annotations to help guide it:
     is missing or has more PVC than needed, the PVC is deleted.
 
 The operator is expected to run as a single-replica Deployment in Kubernetes,
-and needs a ClusterRole with sufficient permissions to list STS, and list and
-patch PVCs. It needs cloudtrail:LookupEvents IAM to check the PVC status.
+and needs a ClusterRole with sufficient permissions to list and watch STS
+and PVs, and list, watch and patch PVCs. It needs cloudtrail:LookupEvents IAM to check the PVC status.
 
 Log level defaults to INFO but will be lowered to DEBUG if ${OPERATOR_DEBUG}
 environment variable is set.
@@ -20,42 +20,411 @@ environment variable is set.
 import boto3
 import logging
 import os
+import signal
+from botocore.config import Config
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime, timedelta, timezone
-from kubernetes import client, config
-from time import sleep
+from kubernetes import client, config, watch
+from kubernetes.utils.quantity import parse_quantity
+from queue import Empty, SimpleQueue
+from threading import Event, Lock, Thread
+from time import monotonic, sleep
+from types import MappingProxyType
+
+# Stands in for the annotations of objects that have none, which the
+# kubernetes client gives us as None. Read-only, since it's shared.
+no_annotations = MappingProxyType({})
+
+# Recent CloudTrail answers, keyed by PV name, as (event_name, event_time, cached_at)
+ct_cache = {}
+# One lock per PV name, so concurrent misses for the same PV share one lookup
+ct_lookup_locks = {}
+ct_lookup_locks_lock = Lock()
+# How long a CloudTrail answer can be reused. CloudTrail itself lags by ~5
+# minutes, so this doesn't add staleness beyond what we already live with.
+ct_cache_ttl = timedelta(minutes=5)
+# How many PVCs a sweep processes at once
+pvc_workers = 8
+# Size of the apiserver connection pool. Each watch holds a connection open,
+# so this leaves a kept-alive connection for every sweep worker and more.
+kube_pool_size = 16
+# How many CloudTrail lookups may be in flight at once. Lookups are also
+# paced by cloudtrail_limiter, since the API is rate limited to 2 TPS.
+ct_max_workers = 2
+
+class RateLimiter():
+    """Space out calls so no more than `rate` of them start per second.
+
+    Safe to share between threads.
+    """
+    def __init__(self, rate):
+        self.interval = 1 / rate
+        self._lock = Lock()
+        self._next = monotonic()
+
+    def wait(self):
+        """Block until the caller is allowed to make its call."""
+        with self._lock:
+            now = monotonic()
+            delay = self._next - now
+            self._next = max(now, self._next) + self.interval
+        if delay > 0:
+            sleep(delay)
+
+cloudtrail_limiter = RateLimiter(2)
+
+# The (uid, size) each PVC was last patched to, keyed by (namespace, name),
+# so we don't patch again before the watch has shown us the first one. The
+# uid tells a PVC recreated under the same name apart from the one we patched.
+last_patched = {}
+
+# (namespace, name) of PVCs that a watch has told us need another look. A
+# None in the queue just wakes main() up, e.g. to notice a shutdown. Unlike
+# Queue, SimpleQueue.put is reentrant, so the SIGTERM handler can use it
+# even if it interrupts main() inside work_queue.get().
+work_queue = SimpleQueue()
+# Set when it's time to stop processing PVCs
+shutdown = Event()
+# Seconds between sweeps over every PVC, to catch what the watches can't
+sweep_interval = 300
+# Seconds between heartbeat writes
+heartbeat_interval = 30
+
+class BufferedFileHandler(logging.FileHandler):
+    """Like FileHandler, but lets records collect in the file's write buffer
+    instead of flushing to disk after every one.
+
+    Records at flush_level or above are flushed right away, along with
+    everything logged before them. A background thread flushes whatever is
+    left every flush_interval seconds until the handler is closed, and
+    logging flushes at exit.
+    """
+    def __init__(self, filename, flush_level=logging.WARNING, flush_interval=5):
+        super().__init__(filename)
+        self.flush_level = flush_level
+        self.flush_interval = flush_interval
+        self._stop_flushing = Event()
+        self._flusher = Thread(target=self._flush_periodically, daemon=True)
+        self._flusher.start()
+
+    def emit(self, record):
+        try:
+            self.stream.write(self.format(record) + self.terminator)
+            if record.levelno >= self.flush_level:
+                self.flush()
+        except Exception:
+            self.handleError(record)
+
+    def close(self):
+        # Don't join the flush thread. logging.shutdown() holds our lock while
+        # it calls close(), and the thread may be waiting on that lock to
+        # flush. Once the stream is closed, that flush does nothing and the
+        # thread sees _stop_flushing and exits.
+        self._stop_flushing.set()
+        super().close()
+
+    def _flush_periodically(self):
+        while not self._stop_flushing.wait(self.flush_interval):
+            self.flush()
+
+class Reflector():
+    """Keep a local copy of a Kubernetes resource, kept current by a watch.
+
+    Modeled on client-go's Reflector: LIST once to fill the store, then WATCH
+    from the resourceVersion that the LIST returned. If the watch falls too
+    far behind and the apiserver answers 410 Gone, LIST again and start over.
+
+    list_func is a cluster-wide list function from the kubernetes client,
+    e.g. v1.list_persistent_volume_claim_for_all_namespaces. Objects are
+    stored keyed by (namespace, name). If on_event is given, it is called
+    with the event type and object for every WATCH event, after the store
+    has been updated.
+
+    If index_func is given, objects are also indexed by whatever it returns
+    for them (None leaves the object out of the index), and by_index looks
+    them up by that value.
+
+    If label_selector is given, it is passed to every LIST and WATCH so the
+    apiserver only sends us matching objects.
+    """
+    def __init__(self, list_func, on_event=None, index_func=None, label_selector=None,
+                 page_size=500, watch_timeout=300):
+        self.list_func = list_func
+        self.on_event = on_event
+        self.index_func = index_func
+        self.selector_kwargs = {'label_selector': label_selector} if label_selector else {}
+        self.page_size = page_size
+        self.watch_timeout = watch_timeout
+        self._store = {}
+        self._index = {}
+        self._lock = Lock()
+        self._rv = None
+
+    def get(self, namespace, name):
+        """Return the cached object, or None if it doesn't exist."""
+        with self._lock:
+            return self._store.get((namespace, name))
+
+    def items(self):
+        """Return a snapshot list of every object in the store."""
+        with self._lock:
+            return list(self._store.values())
+
+    def by_index(self, index_value):
+        """Return a list of every object that index_func mapped to index_value."""
+        with self._lock:
+            return [self._store[key] for key in self._index.get(index_value, ())]
+
+    def _add(self, obj):
+        """Add or replace an object in the store and index. Hold the lock."""
+        key = (obj.metadata.namespace, obj.metadata.name)
+        self._remove(key)
+        self._store[key] = obj
+        if self.index_func:
+            index_value = self.index_func(obj)
+            if index_value is not None:
+                self._index.setdefault(index_value, set()).add(key)
+
+    def _remove(self, key):
+        """Remove an object from the store and index, if it's there. Hold the
+        lock."""
+        obj = self._store.pop(key, None)
+        if obj is not None and self.index_func:
+            index_value = self.index_func(obj)
+            keys = self._index.get(index_value)
+            if keys:
+                keys.discard(key)
+                if not keys:
+                    del self._index[index_value]
+
+    def list(self):
+        """Replace the store with a fresh paginated LIST of the resource.
+
+        resource_version=0 with NotOlderThan lets the apiserver answer from
+        its watch cache instead of going all the way to etcd. The apiserver
+        rejects a resourceVersion alongside a continue token, so later pages
+        only pass the token.
+        """
+        objs = []
+        kwargs = {'resource_version': '0', 'resource_version_match': 'NotOlderThan'}
+        while True:
+            page = self.list_func(limit=self.page_size, **self.selector_kwargs, **kwargs)
+            objs.extend(page.items)
+            if not page.metadata._continue:
+                break
+            kwargs = {'_continue': page.metadata._continue}
+        with self._lock:
+            self._store = {}
+            self._index = {}
+            for obj in objs:
+                self._add(obj)
+        self._rv = page.metadata.resource_version
+        logger.debug("Reflector listed %s objects at resourceVersion %s", len(objs), self._rv)
+
+    def watch(self):
+        """Apply WATCH events to the store until the watch times out.
+
+        timeout_seconds only asks the apiserver to end the watch. The client
+        side read timeout is what stops a silently dropped connection from
+        blocking us forever with a stale store.
+
+        Raises ApiException with status 410 if our resourceVersion has expired.
+        """
+        w = watch.Watch()
+        for event in w.stream(self.list_func,
+                              resource_version      = self._rv,
+                              timeout_seconds       = self.watch_timeout,
+                              _request_timeout      = self.watch_timeout + 30,
+                              allow_watch_bookmarks = True,
+                              **self.selector_kwargs):
+            obj = event['object']
+            # Bookmarks only carry a resourceVersion, and aren't deserialized
+            if event['type'] == 'BOOKMARK':
+                self._rv = obj['metadata']['resourceVersion']
+                continue
+            with self._lock:
+                if event['type'] == 'DELETED':
+                    self._remove((obj.metadata.namespace, obj.metadata.name))
+                else:
+                    self._add(obj)
+            self._rv = obj.metadata.resource_version
+            if self.on_event:
+                self.on_event(event['type'], obj)
+
+    def run(self):
+        """Watch forever, re-listing whenever the watch can't be resumed."""
+        while True:
+            try:
+                if self._rv is None:
+                    self.list()
+                self.watch()
+            except Exception as e:
+                # Dying here would silently leave a stale store behind, so
+                # recover from anything by starting over with a fresh LIST.
+                if getattr(e, 'status', None) == 410:
+                    logger.info("Reflector resourceVersion expired, re-listing")
+                else:
+                    logger.warning("Reflector watch failed, re-listing: %s", e)
+                    sleep(5)
+                self._rv = None
+
+    def start(self):
+        """Do the initial LIST, then keep watching in a background thread."""
+        self.list()
+        Thread(target=self.run, daemon=True).start()
 
 def main():
-    """Loop through all PVCs and perform necessary actions."""
-    while True:
-        logger.debug("Starting main() loop")
+    """Process PVCs as the watches report changes to them, plus a periodic
+    sweep over every PVC.
+
+    The sweep is what notices orphaned PVCs passing their grace period, since
+    nothing in Kubernetes changes when that happens. It also covers anything
+    the watches missed.
+
+    Returns once shutdown is set.
+    """
+    pvc_cache.start()
+    sts_cache.start()
+    pv_cache.start()
+
+    next_sweep = next_heartbeat = monotonic()
+    while not shutdown.is_set():
+        if monotonic() >= next_sweep:
+            sweep()
+            next_sweep = monotonic() + sweep_interval
+        # Only rewrite the heartbeat when it's due, not for every event
+        if monotonic() >= next_heartbeat:
+            health_check()
+            next_heartbeat = monotonic() + heartbeat_interval
+
+        # Wake up in time for whichever of the two is due next
+        try:
+            key = work_queue.get(timeout=max(0, min(next_sweep, next_heartbeat) - monotonic()))
+        except Empty:
+            continue
+        if key is None:
+            continue
+        pvc = pvc_cache.get(*key)
+        if pvc:
+            process_pvc(pvc)
+    logger.info("Stopped processing PVCs")
+
+def request_shutdown(signum=None, frame=None):
+    """Make main() return after the PVC it's working on. This is the SIGTERM
+    handler, so Kubernetes doesn't have to wait out the grace period and
+    SIGKILL us."""
+    shutdown.set()
+    work_queue.put(None)
+
+def sweep():
+    """Process every managed PVC in the cache, pvc_workers at a time.
+
+    Each PVC is in the cache once, so no two workers ever touch the same PVC.
+    """
+    logger.debug("Starting sweep")
+
+    pvcs = [pvc for pvc in pvc_cache.items()
+            if (pvc.metadata.annotations or no_annotations).get('pvc-operator/statefulset')]
+
+    # Ask CloudTrail about every deletion candidate up front, a few at a
+    # time, so delete_if_needed finds the answers already cached.
+    prefetch_attachment_events([pvc for pvc in pvcs if is_orphaned(pvc)])
+
+    def process_unless_shutdown(pvc):
+        if not shutdown.is_set():
+            process_pvc(pvc)
+
+    with ThreadPoolExecutor(max_workers=pvc_workers) as executor:
+        # Consume the results, so that errors are raised here like before
+        list(executor.map(process_unless_shutdown, pvcs))
+
+def process_pvc(pvc):
+    """Delete or resize a single PVC, if it's managed and needs it."""
+    logger.debug("Processing PVC %s.%s", pvc.metadata.namespace, pvc.metadata.name)
+    annotations = pvc.metadata.annotations or no_annotations
+    if not annotations.get('pvc-operator/statefulset'): return
+    sts = get_sts_for_pvc(pvc)
+    if delete_if_needed(pvc, sts): return
+    resize_if_needed(pvc, sts)
+
+def on_pvc_event(event_type, pvc):
+    """Queue a changed PVC to be processed. Deleted PVCs need nothing more,
+    but a PVC recreated under the same name mustn't inherit its last patch.
+
+    Meant to be the on_event callback of the PVC Reflector.
+    """
+    key = (pvc.metadata.namespace, pvc.metadata.name)
+    if event_type == 'DELETED':
+        last_patched.pop(key, None)
+    else:
+        forget_stale_patch(pvc)
+        work_queue.put(key)
+
+def forget_stale_patch(pvc):
+    """Drop a PVC's last_patched entry once it no longer applies, because the
+    PVC has caught up with the patch or was recreated under the same name.
+
+    Deletions can be missed while a Reflector re-lists, so the uid is what
+    catches a recreated PVC.
+    """
+    key = (pvc.metadata.namespace, pvc.metadata.name)
+    patched = last_patched.get(key)
+    if not patched:
+        return
+    uid, size = patched
+    if (uid != pvc.metadata.uid or
+        parse_quantity(pvc.spec.resources.requests['storage']) >= parse_quantity(size)):
+        last_patched.pop(key, None)
+
+def on_sts_event(event_type, sts):
+    """Queue every PVC that points at a changed or deleted STS.
+
+    Meant to be the on_event callback of the STS Reflector.
+    """
+    for pvc in pvc_cache.by_index((sts.metadata.namespace, sts.metadata.name)):
+        work_queue.put((pvc.metadata.namespace, pvc.metadata.name))
 
-        pvcs = v1.list_persistent_volume_claim_for_all_namespaces().items
-        for pvc in pvcs:
-            logger.debug(f"Processing PVC {pvc.metadata.namespace}.{pvc.metadata.name}")
-            if not pvc.metadata.annotations.get('pvc-operator/statefulset'): continue
-            if delete_if_needed(pvc): continue
-            resize_if_needed(pvc)
+def sts_key_for_pvc(pvc):
+    """Return the (namespace, name) of the STS a PVC points at, or None for
+    an unmanaged PVC.
 
-        health_check()
-        sleep(30)
+    Meant to be the index_func of the PVC Reflector.
+    """
+    sts_pointer = (pvc.metadata.annotations or no_annotations).get('pvc-operator/statefulset')
+    if not sts_pointer:
+        return None
+    return (pvc.metadata.namespace, sts_pointer)
 
-def delete_if_needed(pvc):
-    """Delete the PVC if the associated STS is scaled down or deleted.
+def on_pv_event(event_type, pv):
+    """Queue the PVC bound to a changed PV. Once a PV is deleted, drop its
+    cached CloudTrail answer instead.
+
+    Meant to be the on_event callback of the PV Reflector.
+    """
+    if event_type == 'DELETED':
+        ct_cache.pop(pv.metadata.name, None)
+        with ct_lookup_locks_lock:
+            ct_lookup_locks.pop(pv.metadata.name, None)
+    elif pv.spec.claim_ref:
+        work_queue.put((pv.spec.claim_ref.namespace, pv.spec.claim_ref.name))
+
+def delete_if_needed(pvc, sts):
+    """Delete the PVC if the associated STS is scaled down or deleted. sts is
+    the PVC's StatefulSet as returned by get_sts_for_pvc.
 
     Return True if deleted, False otherwise.
     """
-    logger.debug(f"delete_if_needed {pvc.metadata.namespace}.{pvc.metadata.name}")
-    # Find the associated statefulset
-    sts = get_sts_for_pvc(pvc)
+    namespace, name = pvc.metadata.namespace, pvc.metadata.name
+    logger.debug("delete_if_needed %s.%s", namespace, name)
 
     # Delete if STS is missing
     if not sts:
         if not pvc_unmounted_long_enough(pvc):
             return False
-        logger.info(f"Deleting orphaned PVC {pvc.metadata.namespace}.{pvc.metadata.name}")
+        logger.info("Deleting orphaned PVC %s.%s", namespace, name)
         v1.delete_namespaced_persistent_volume_claim(
-            name      = pvc.metadata.name,
-            namespace = pvc.metadata.namespace
+            name      = name,
+            namespace = namespace
         )
         return True
     
@@ -64,101 +433,103 @@ def delete_if_needed(pvc):
     pvc_ordinal = get_ordinal(pvc)
     if (pvc_ordinal >= sts_replicas  # the highest PVC should be replicas - 1
         and pvc_unmounted_long_enough(pvc)):
-        logger.info(f"Deleting downscaled PVC {pvc.metadata.namespace}.{pvc.metadata.name}")
+        logger.info("Deleting downscaled PVC %s.%s", namespace, name)
         v1.delete_namespaced_persistent_volume_claim(
-            name      = pvc.metadata.name,
-            namespace = pvc.metadata.namespace
+            name      = name,
+            namespace = namespace
         )
         return True
     
     # Nothing was deleted
     return False
 
-def resize_if_needed(pvc):
-    """Grow the PVC if the desired size has increased.
+def is_orphaned(pvc):
+    """Return True if the PVC's STS is missing or has been scaled down below
+    the PVC's ordinal, meaning the PVC is a candidate for deletion."""
+    sts = get_sts_for_pvc(pvc)
+    return not sts or get_ordinal(pvc) >= sts.spec.replicas
+
+def resize_if_needed(pvc, sts):
+    """Grow the PVC if the desired size has increased. sts is the PVC's
+    StatefulSet as returned by get_sts_for_pvc.
 
     Shrinking PVC is not supported, because shrinking EBS is not supported by AWS.
 
     Return True if resized, False otherwise.
     """
-    logger.debug(f"resize_if_needed {pvc.metadata.namespace}.{pvc.metadata.name}")
-
-    sts = get_sts_for_pvc(pvc)
-    current_size = pvc.spec.resources.requests['storage'].strip()
-    desired_size = get_pvc_desired_size(sts).strip()
+    namespace, name = pvc.metadata.namespace, pvc.metadata.name
+    logger.debug("resize_if_needed %s.%s", namespace, name)
 
-    # Validate the inputs. Units other than Gi should not have made it past
-    # linting, but that doesn't relieve us of our duty to check.
-    if current_size[-2:] != 'Gi':
-        logger.warning(f"PVC {pvc.metadata.namespace}.{pvc.metadata.name} has invalid units. Doing nothing.")
+    # An orphaned PVC that's still in its grace period has nothing to be
+    # sized against
+    if not sts:
+        logger.debug("...STS is missing")
         return False
-    if desired_size[-2:] != 'Gi':
-        logger.warning(f"STS {sts.metadata.namespace}.{sts.metadata.name} has invalid units. Doing nothing.")
+
+    key = (namespace, name)
+    current_size = pvc.spec.resources.requests['storage']
+    desired_size = get_pvc_desired_size(sts)
+
+    # The cached PVC can lag behind our own patch. Don't send it twice.
+    forget_stale_patch(pvc)
+    if last_patched.get(key) == (pvc.metadata.uid, desired_size):
+        logger.debug("...already patched to %s, waiting for the watch to catch up", desired_size)
         return False
 
-    # Strip the unit off the end so we can do numeric comparison
-    current_size_int = int(current_size[:-2])
-    desired_size_int = int(desired_size[:-2])
+    # Compare in bytes, so that e.g. 1Ti and 1024Gi are the same size
+    current_bytes = parse_quantity(current_size)
+    desired_bytes = parse_quantity(desired_size)
 
-    if current_size_int == desired_size_int:
-        logger.debug(f"...size already matches")
+    if current_bytes == desired_bytes:
+        logger.debug("...size already matches")
         return False
-    if current_size_int > desired_size_int:
-        logger.warning(f"PVC {pvc.metadata.namespace}.{pvc.metadata.name} is larger than desired size {desired_size}")
+    if current_bytes > desired_bytes:
+        logger.warning("PVC %s.%s is larger than desired size %s", namespace, name, desired_size)
         return False
 
     # Patch the PVC with the new size
-    logger.info(f"Resizing PVC {pvc.metadata.namespace}.{pvc.metadata.name} to {desired_size}")
+    logger.info("Resizing PVC %s.%s to %s", namespace, name, desired_size)
     patch = {"spec": {"resources": {"requests": {"storage": desired_size}}}}
     v1.patch_namespaced_persistent_volume_claim(
-        namespace = pvc.metadata.namespace,
-        name      = pvc.metadata.name,
+        namespace = namespace,
+        name      = name,
         body      = patch
     )
+    last_patched[key] = (pvc.metadata.uid, desired_size)
     return True
 
 def get_sts_for_pvc(pvc):
     """Return the single StatefulSet object for this PersistentVolumeClaim,
     or False if the StatefulSet doesn't exist.
     
-    This is done by following the pvc-operator/statefulset annotation. If the
-    annotation itself is missing, throw a RuntimeWarning.
-    
-    If multiple STS are found, throw a RuntimeError instead."""
+    This is done by following the pvc-operator/statefulset annotation into
+    the STS cache. If the annotation itself is missing, throw a RuntimeWarning."""
+    meta = pvc.metadata
+    namespace = meta.namespace
     # Grab the pointer
-    sts_pointer = pvc.metadata.annotations.get('pvc-operator/statefulset')
+    sts_pointer = (meta.annotations or no_annotations).get('pvc-operator/statefulset')
 
     # A missing pointer means this isn't a managed PVC. It shouldn't have
-    # been passed to this function in the first place, because main() already
-    # checks for the annotation. This is probably a mistake.
+    # been passed to this function in the first place, because process_pvc()
+    # already checks for the annotation. This is probably a mistake.
     if not sts_pointer:
-        logger.warning(f"get_sts_for_pvc was passed a non-managed PVC {pvc.metadata.namespace}.{pvc.metadata.name}")
+        logger.warning("get_sts_for_pvc was passed a non-managed PVC %s.%s", namespace, meta.name)
         # We raise an exception instead of returning False, because there's a
         # difference between the pointer referencing a missing object, and the
         # pointer itself being missing. Mistaking the two could mean deleting
         # something we're not supposed to.
         raise RuntimeWarning("get_sts_for_pvc was passed a non-managed PVC")
 
-    # Follow the pointer
-    sts_list = appsv1.list_namespaced_stateful_set(
-        namespace      = pvc.metadata.namespace,
-        field_selector = f'metadata.name={sts_pointer}'
-    )
+    # Follow the pointer. The cache is keyed by (namespace, name), so there
+    # can only ever be one match.
+    sts = sts_cache.get(namespace, sts_pointer)
 
-    # Die if more than one STS is found. How is this even possible given a
-    # filter on metadata.name? Probably this would never come up, but let's
-    # check anyway.
-    if len(sts_list.items) > 1:
-        logger.error(f"get_sts_for_pvc found multiple STS matching pointer {sts_pointer}. This shouldn't be possible. Bailing!")
-        logger.error(sts_list)
-        raise RuntimeError("get_sts_for_pvc found multiple matching STS")
-    
-    # An empty list means the STS has been deleted and the PVC is orphaned.
-    if not sts_list.items:
+    # A missing STS means it has been deleted and the PVC is orphaned.
+    if not sts:
         return False
 
     # We've found the associated StatefulSet. Return it.
-    return sts_list.items[0]
+    return sts
 
 def get_ordinal(obj):
     """Return the ordinal of the Kubernetes Object.
@@ -170,27 +541,32 @@ def get_ordinal(obj):
     # In the same way, each Pod created by a StatefulSet is named like
     #    StatefulSetName-Ordinal
     # Generically, that means we can return the ordinal of any ordered object by
-    # splitting on hyphens and returning the last item.
+    # splitting off the last hyphen and returning what's after it.
     # For more information, see: https://kubernetes.io/docs/concepts/workloads/controllers/statefulset/#ordinal-index
-    ordinal = obj.metadata.name.split('-')[-1]
-    if not ordinal.isnumeric():
+    try:
+        return int(obj.metadata.name.rsplit('-', 1)[-1])
+    except ValueError:
         logger.error("get_ordinal received a non-ordered input")
         raise RuntimeWarning("get_ordinal received a non-ordered input")
-    return int(ordinal)
 
 def get_pvc_desired_size(sts):
     """Return the desired size of the PersistentVolumes for this StatefulSet.
 
     Throws a RuntimeWarning if the pvc-operator/storage-size annotation is
-    missing or incorrectly formatted.
+    missing or isn't a Kubernetes quantity with units (e.g. 500Gi or 1Ti).
     """
-    desired_size = sts.metadata.annotations.get('pvc-operator/storage-size')
+    desired_size = (sts.metadata.annotations or no_annotations).get('pvc-operator/storage-size')
     if not desired_size:
-        logger.warning(f"get_pvc_desired_size received STS {sts.metadata.namespace}.{sts.metadata.name} with missing annotation")
+        logger.warning("get_pvc_desired_size received STS %s.%s with missing annotation", sts.metadata.namespace, sts.metadata.name)
         raise RuntimeWarning("get_pvc_desired_size received STS with missing annotation")
-    if (not desired_size.endswith("Gi") or
-        not desired_size.split("Gi")[0].isnumeric()):
-        logger.warning(f"get_pvc_desired_size received STS {sts.metadata.namespace}.{sts.metadata.name} with malformed annotation")
+    # A bare number is a size in bytes, which is almost certainly a mistake
+    try:
+        parse_quantity(desired_size)
+        malformed = desired_size[-1].isdigit()
+    except ValueError:
+        malformed = True
+    if malformed:
+        logger.warning("get_pvc_desired_size received STS %s.%s with malformed annotation", sts.metadata.namespace, sts.metadata.name)
         raise RuntimeWarning("get_pvc_desired_size received STS with malformed annotation")
     return desired_size
 
@@ -201,70 +577,142 @@ def pvc_unmounted_long_enough(pvc):
     Finds the volume in AWS to check the unmount time. Kubernetes does not
     expose this information.
     """
-    logger.debug(f"pvc_unmounted_long_enough {pvc.metadata.namespace}.{pvc.metadata.name}")
-    # Find the EBS volume ID from kube
-    ebs_volume = get_volume_id(pvc.spec.volume_name)
+    logger.debug("pvc_unmounted_long_enough %s.%s", pvc.metadata.namespace, pvc.metadata.name)
+    event_name, event_time = get_cached_attachment_event(pvc.spec.volume_name)
 
-    # Look through CloudTrail events for that volume. This API is rate limited to 2 TPS.
-    events = cloudtrail.lookup_events(
-        LookupAttributes=[
-            {
-                'AttributeKey': 'ResourceName',
-                'AttributeValue': ebs_volume
-            },
-        ],
-        MaxResults=30  # the event we're looking for could get drowned out by other stuff like tagging
-    )
-    for event in events['Events']:
-        # The event list is pre-sorted with most recent first, so we just find
-        # the first attachment-related event and return.
-        if event['EventName'] == 'AttachVolume':
-            # It's been attached most recently, it is not safe to delete
-            logger.debug("...it still looks attached, return false")
+    if event_name == 'AttachVolume':
+        # It's been attached most recently, it is not safe to delete
+        logger.debug("...it still looks attached, return false")
+        return False
+    if event_name == 'DetachVolume':
+        # It's been detatched most recently, but how long ago?
+        time_since_detatch = datetime.now(timezone.utc) - event_time
+        if time_since_detatch > pvc_grace_minutes:
+            # It's been detatched long enough, OK to delete
+            logger.debug("...it's been detatched a while, return true")
+            return True
+        else:
+            logger.debug("...it hasn't been detatched long, return false")
             return False
-        if event['EventName'] == 'DetachVolume':
-            # It's been detatched most recently, but how long ago?
-            time_since_detatch = datetime.now(timezone.utc) - event['EventTime']
-            if time_since_detatch > pvc_grace_minutes:
-                # It's been detatched long enough, OK to delete
-                logger.debug("...it's been detatched a while, return true")
-                return True
-            else:
-                logger.debug("...it hasn't been detatched long, return false")
-                return False
 
     # If we got here, we didn't find any Attach/Detach events. CloudTrail has
     # a ~5 minute delay, but unless we are rapidly scaling a new STS up and
     # down I'd still expect to see something. Maybe the interesting events
-    # got drowned out by other stuff like tagging? We grabbed 30 results so
+    # got drowned out by other stuff like tagging? We grabbed 60 results so
     # that's a _lot_ of tagging...
-    logger.warning(f"Didn't find any attach or detatch events for PVC {pvc.metadata.namespace}.{pvc.metadata.name}")
+    logger.warning("Didn't find any attach or detatch events for PVC %s.%s", pvc.metadata.namespace, pvc.metadata.name)
     return False
 
+def prefetch_attachment_events(pvcs):
+    """Look up the CloudTrail attachment events for a list of PVCs, up to
+    ct_max_workers at a time, and store them in ct_cache.
+
+    Errors are left for pvc_unmounted_long_enough to run into and report.
+    Lookups that haven't started by the time shutdown is set are skipped,
+    since at 2 TPS a long prefetch could outlast the termination grace period.
+    """
+    logger.debug("prefetch_attachment_events for %s PVCs", len(pvcs))
+
+    def fetch_unless_shutdown(pv_name):
+        if not shutdown.is_set():
+            get_cached_attachment_event(pv_name)
+
+    with ThreadPoolExecutor(max_workers=ct_max_workers) as executor:
+        futures = [executor.submit(fetch_unless_shutdown, pvc.spec.volume_name)
+                   for pvc in pvcs]
+    for future in futures:
+        if future.exception():
+            logger.debug("...prefetch failed: %s", future.exception())
+
+def get_cached_attachment_event(pv_name):
+    """Return the (EventName, EventTime) of the last attachment event for the
+    EBS volume behind a PersistentVolume, reusing a recent answer from
+    ct_cache if there is one.
+
+    If several threads ask about the same PV at once, only the first one
+    calls CloudTrail. The others wait and get its answer.
+    """
+    with ct_lookup_locks_lock:
+        lookup_lock = ct_lookup_locks.setdefault(pv_name, Lock())
+
+    with lookup_lock:
+        now = datetime.now(timezone.utc)
+        cached = ct_cache.get(pv_name)
+        if cached and now - cached[2] < ct_cache_ttl:
+            logger.debug("...using cached CloudTrail event for PV %s", pv_name)
+            return cached[0], cached[1]
+
+        # Find the EBS volume ID from kube, then ask CloudTrail about it
+        ebs_volume = get_volume_id(pv_name)
+        event_name, event_time = get_last_attachment_event(ebs_volume)
+        ct_cache[pv_name] = (event_name, event_time, now)
+        return event_name, event_time
+
+def get_last_attachment_event(ebs_volume):
+    """Return the (EventName, EventTime) of the most recent AttachVolume or
+    DetachVolume CloudTrail event for an EBS volume, or (None, None) if there
+    isn't one.
+    """
+    logger.debug("get_last_attachment_event %s", ebs_volume)
+    # Page through CloudTrail events for that volume, most recent first. The
+    # event we're looking for could get drowned out by other stuff like
+    # tagging, but it's usually on the first page, so only fetch more pages
+    # while we haven't found it. There's no StartTime: a volume detatched
+    # long ago is exactly the one we want to find.
+    page_size, max_pages = 20, 3
+    pages = cloudtrail.get_paginator('lookup_events').paginate(
+        LookupAttributes=[
+            {
+                'AttributeKey': 'ResourceName',
+                'AttributeValue': ebs_volume
+            },
+        ],
+        PaginationConfig={'PageSize': page_size, 'MaxItems': page_size * max_pages}
+    )
+    # Each page is a call to an API that is rate limited to 2 TPS, so wait
+    # before every page that will actually be fetched, and no more.
+    cloudtrail_limiter.wait()
+    for page_number, page in enumerate(pages, 1):
+        for event in page['Events']:
+            # The event list is pre-sorted with most recent first, so we just
+            # find the first attachment-related event and return.
+            if event['EventName'] in ('AttachVolume', 'DetachVolume'):
+                return event['EventName'], event['EventTime']
+        if page_number == max_pages or not page.get('NextToken'):
+            break
+        cloudtrail_limiter.wait()
+    return None, None
+
 def get_volume_id(pv_name):
     """Return the AWS EBS volume ID backing a PersistentVolume. Supports gp2
     and gp3 volumes.
 
     Throws a RuntimeError if it can't find the volume ID.
     """
-    logger.debug(f"get_volume_id {pv_name}")
-    pv = v1.list_persistent_volume(field_selector=f'metadata.name={pv_name}')
-    if pv.items[0].spec.aws_elastic_block_store:
+    logger.debug("get_volume_id %s", pv_name)
+    # PersistentVolumes are cluster-scoped, so they have no namespace
+    pv = pv_cache.get(None, pv_name)
+    if not pv:
+        logger.error("get_volume_id couldn't find PV %s", pv_name)
+        raise RuntimeError("get_volume_id couldn't find the PV")
+    if pv.spec.aws_elastic_block_store:
         # gp2 location
-        ebs_volume = pv.items[0].spec.aws_elastic_block_store.volume_id.split('/')[-1]  # formatted like 'aws://us-east-1c/vol-0a6d7a39a07212c42'
-    elif pv.items[0].spec.csi:
+        ebs_volume = pv.spec.aws_elastic_block_store.volume_id.split('/')[-1]  # formatted like 'aws://us-east-1c/vol-0a6d7a39a07212c42'
+    elif pv.spec.csi:
         # gp3 location
-        ebs_volume = pv.items[0].spec.csi.volume_handle  # formatted like 'vol-0a6d7a39a07212c42'
+        ebs_volume = pv.spec.csi.volume_handle  # formatted like 'vol-0a6d7a39a07212c42'
     else:
-        logger.error(f"get_volume_id couldn't find the volume ID for PV {pv_name}")
+        logger.error("get_volume_id couldn't find the volume ID for PV %s", pv_name)
         raise RuntimeError("get_volume_id couldn't find the volume ID")
     return ebs_volume
 
 def ready_check(check_file='/tmp/heartbeat'):
     """Verifies dependencies and writes out /tmp/heartbeat."""
-    # Verify network and permissions by making each of the major API calls
-    v1.list_persistent_volume_claim_for_all_namespaces()
-    appsv1.list_stateful_set_for_all_namespaces()
+    # Verify network and permissions by making each of the major API calls.
+    # One object is enough to prove access; the Reflectors do the real LISTs.
+    v1.list_persistent_volume_claim_for_all_namespaces(limit=1)
+    v1.list_persistent_volume(limit=1)
+    appsv1.list_stateful_set_for_all_namespaces(limit=1)
     cloudtrail.lookup_events(MaxResults=1)
     # If we got this far without exception, we are ready
     with open(check_file, 'w') as f:
@@ -276,13 +724,18 @@ def health_check(check_file='/tmp/heartbeat'):
         f.write('running\n')
 
 if __name__ == "__main__":
+    # Our format only uses the time, level and message, so don't make every
+    # log record look up process and thread details too
+    logging.logProcesses = False
+    logging.logThreads = False
+    logging.logMultiprocessing = False
     # Log everything to both stdout and to file
     logFormatter = logging.Formatter('%(asctime)s %(levelname)s: %(message)s')
     rootLogger = logging.getLogger()
     consoleHandler = logging.StreamHandler()
     consoleHandler.setFormatter(logFormatter)
     rootLogger.addHandler(consoleHandler)
-    fileHandler = logging.FileHandler("/app/logs/operator-pvc-manager.log")
+    fileHandler = BufferedFileHandler("/app/logs/operator-pvc-manager.log")
     fileHandler.setFormatter(logFormatter)
     rootLogger.addHandler(fileHandler)
     # Create our own logger for this app and set log level
@@ -298,6 +751,9 @@ if __name__ == "__main__":
     else:
         pvc_grace_minutes = timedelta(hours=1)
 
+    # Opt-in: without a selector every PVC is watched, and the annotation alone decides
+    pvc_label_selector = os.environ.get('PVC_LABEL_SELECTOR')
+
     logger.info("Started PVC Operator")
 
     # Find the kubeconfig dynamically, allows for local testing
@@ -307,17 +763,39 @@ if __name__ == "__main__":
     else:
         logger.info("Working in local environment talking to a remote kubernetes cluster")
         config.load_kube_config()
+    kube_config = client.Configuration.get_default_copy()
+    kube_config.connection_pool_maxsize = kube_pool_size
+    client.Configuration.set_default(kube_config)
 
+    # Share one ApiClient, and so one connection pool, between the API groups
+    api_client = client.ApiClient()
     # Start a kubernetes Core V1 client
-    v1 = client.CoreV1Api()
+    v1 = client.CoreV1Api(api_client)
     # Start an Apps V1 Client (statefulsets)
-    appsv1 = client.AppsV1Api()
-    # Start an AWS CloudTrail Client
-    cloudtrail = boto3.client('cloudtrail')  # TODO do we need to auto-refresh this token?
+    appsv1 = client.AppsV1Api(api_client)
+    # Start an AWS CloudTrail Client from a long-lived Session. The Session
+    # refreshes role credentials on its own as they near expiry. There's one
+    # pooled connection per prefetch worker so they can reuse TLS sessions,
+    # and adaptive retries back off client-side when CloudTrail throttles us.
+    aws_session = boto3.Session()
+    cloudtrail = aws_session.client('cloudtrail', config=Config(
+        max_pool_connections = ct_max_workers,
+        tcp_keepalive        = True,
+        retries              = {'mode': 'adaptive', 'max_attempts': 5}
+    ))
+
+    # Local caches of all PVCs, STS and PVs, kept current by watches
+    pvc_cache = Reflector(v1.list_persistent_volume_claim_for_all_namespaces,
+                          on_event=on_pvc_event, index_func=sts_key_for_pvc,
+                          label_selector=pvc_label_selector)
+    sts_cache = Reflector(appsv1.list_stateful_set_for_all_namespaces, on_event=on_sts_event)
+    pv_cache = Reflector(v1.list_persistent_volume, on_event=on_pv_event)
 
     # Verify networking and permissions
     ready_check()
 
+    signal.signal(signal.SIGTERM, request_shutdown)
+
     logger.info("Loaded up Kubernetes and AWS clients... let's continue")
     main()
     logger.info("Bye.")
@@ -1,58 +1,146 @@
 import logging
 import pytest
-from datetime import datetime
-from dateutil.tz import tzlocal
-from importlib import reload
-from random import randint
+from datetime import datetime, timezone
+from operator_pvc_manager import operator_pvc_manager as opm
+from queue import SimpleQueue
+from random import choices
+from threading import Event
+from types import SimpleNamespace
 from unittest import mock
 
+# the EBS volume behind the fake PV
+fake_volume_id = 'vol-0a6d7a39a07212c42'
+fake_volume_uri = 'aws://us-east-1c/' + fake_volume_id
+
+@pytest.fixture(autouse=True, scope="session")
+def prewarm_mock():
+  # the first MagicMock of the session pays for setting up the mock
+  # machinery, so pay it here instead of inside whichever test runs first.
+  # The operator module itself is already imported at the top of this file.
+  mock.MagicMock().metadata.name
+
+@pytest.fixture(scope="session")
+def null_logger():
+  # a logger that drops everything before a record is even built
+  null_logger = logging.getLogger('operator-pvc-manager-test')
+  null_logger.handlers = [logging.NullHandler()]
+  null_logger.propagate = False
+  null_logger.setLevel(logging.CRITICAL + 1)
+  return null_logger
 
 @pytest.fixture()
-def operator_pvc_manager():
-  # this fixture is so mocks don't persist between tests
-  from operator_pvc_manager import operator_pvc_manager
-  operator_pvc_manager.logger = logging.getLogger(__name__)
-  yield operator_pvc_manager
-  reload(operator_pvc_manager)
+def operator_pvc_manager(null_logger, monkeypatch):
+  # tests set attributes through monkeypatch, so mocks don't persist between
+  # tests without having to reload the module.
+  # These are only defined when the module runs as __main__
+  for name in ('v1', 'appsv1', 'cloudtrail', 'pvc_cache', 'sts_cache', 'pv_cache', 'pvc_grace_minutes'):
+    monkeypatch.setattr(opm, name, None, raising=False)
+  monkeypatch.setattr(opm, 'logger', null_logger, raising=False)
+  # fresh module state for every test
+  monkeypatch.setattr(opm, 'ct_cache', {})
+  monkeypatch.setattr(opm, 'ct_lookup_locks', {})
+  monkeypatch.setattr(opm, 'last_patched', {})
+  monkeypatch.setattr(opm, 'work_queue', SimpleQueue())
+  monkeypatch.setattr(opm, 'shutdown', Event())
+  # don't make the tests wait out cloudtrail's real rate limit
+  monkeypatch.setattr(opm, 'cloudtrail_limiter', opm.RateLimiter(1000))
+  return opm
 
 @pytest.fixture()
-def appsv1(sts):
+def appsv1():
   appsv1 = mock.MagicMock()
   appsv1.list_stateful_set_for_all_namespaces.return_value = True
-  sts_list = mock.MagicMock()
-  sts_list.items = [sts]
-  appsv1.list_namespaced_stateful_set.return_value = sts_list
   return appsv1
 
+@pytest.fixture()
+def sts_cache(operator_pvc_manager, sts):
+  sts_cache = operator_pvc_manager.Reflector(mock.MagicMock())
+  sts_cache._store[(sts.metadata.namespace, sts.metadata.name)] = sts
+  return sts_cache
+
+@pytest.fixture()
+def volume_id():
+  return fake_volume_id
+
+@pytest.fixture()
+def make_pv():
+  def make_pv(name='some-pv', ebs_volume_id=fake_volume_uri, csi_volume_handle=None,
+              claim=('default', 'some-sts-storage-12')):
+    """Return a fake PV. gp2 volumes have an ebs_volume_id, gp3 volumes have
+    a csi_volume_handle. claim=None leaves it unbound."""
+    return SimpleNamespace(
+      metadata = SimpleNamespace(name=name, namespace=None),
+      spec = SimpleNamespace(
+        aws_elastic_block_store = SimpleNamespace(volume_id=ebs_volume_id) if ebs_volume_id else None,
+        csi                     = SimpleNamespace(volume_handle=csi_volume_handle) if csi_volume_handle else None,
+        claim_ref               = SimpleNamespace(namespace=claim[0], name=claim[1]) if claim else None,
+      ),
+    )
+  return make_pv
+
+@pytest.fixture()
+def pv_cache(operator_pvc_manager, make_pv):
+  pv_cache = operator_pvc_manager.Reflector(mock.MagicMock())
+  pv_cache._store[(None, 'some-pv')] = make_pv()
+  return pv_cache
+
 @pytest.fixture()
 def v1():
   v1 = mock.MagicMock()
   v1.list_persistent_volume_claim_for_all_namespaces.return_value = True
-  pvc = mock.MagicMock()
-  pvc.metadata.name = 'some-pvc'
-  pvc.metadata.namespace = 'default'
-  pvc.metadata.annotations.get.return_value = 'some-sts'
-  v1.list_persistent_volume_claim_for_all_namespaces.items = [pvc]
-  pv = mock.MagicMock()
-  pv.items[0].spec.aws_elastic_block_store.volume_id = 'aws://us-east-1c/vol-0a6d7a39a07212c42'
-  v1.list_persistent_volume.return_value = pv
   return v1
 
 @pytest.fixture()
-def sts():
-  sts = mock.MagicMock()
-  sts.metadata.name = 'some-sts'
-  sts.metadata.namespace = 'default'
-  sts.metadata.annotations = {'pvc-operator/storage-size': '500Gi'}
-  return sts
+def make_sts():
+  def make_sts(name='some-sts', namespace='default', storage_size='500Gi', replicas=3):
+    """Return a fake STS. storage_size=None leaves it unannotated."""
+    return SimpleNamespace(
+      metadata = SimpleNamespace(
+        name        = name,
+        namespace   = namespace,
+        annotations = {'pvc-operator/storage-size': storage_size} if storage_size else {},
+      ),
+      spec = SimpleNamespace(replicas=replicas),
+    )
+  return make_sts
+
+@pytest.fixture()
+def sts(make_sts):
+  return make_sts()
 
 @pytest.fixture()
-def pvc():
-  pvc = mock.MagicMock()
-  pvc.metadata.name = 'some-sts-storage-12'
-  pvc.metadata.namespace = 'default'
-  pvc.metadata.annotations = {'pvc-operator/statefulset': 'some-sts'}
-  return pvc
+def make_pvc():
+  def make_pvc(name='some-sts-storage-12', namespace='default', statefulset='some-sts',
+               volume_name='some-pv', size='500Gi', uid='some-pvc-uid'):
+    """Return a fake PVC. statefulset=None leaves it unmanaged."""
+    return SimpleNamespace(
+      metadata = SimpleNamespace(
+        name             = name,
+        namespace        = namespace,
+        annotations      = {'pvc-operator/statefulset': statefulset} if statefulset else {},
+        resource_version = None,
+        uid              = uid,
+      ),
+      spec = SimpleNamespace(
+        volume_name = volume_name,
+        resources   = SimpleNamespace(requests={'storage': size}),
+      ),
+    )
+  return make_pvc
+
+@pytest.fixture()
+def pvc(make_pvc):
+  return make_pvc()
+
+# canned lookup_events responses, built once rather than on every call
+fake_next_token = '2xx0x1Ec5ChGGwt/RvH4ii6HbkSpkxV0Fxy08nRjHkOV1FXMFZZm6W3/L+l7xz+o'
+fake_response_metadata = {'RequestId': 'c4fa7fcc-3a11-4ba4-8635-da0817c1ab40', 'HTTPStatusCode': 200, 'HTTPHeaders': {'x-amzn-requestid': 'c4fa7fcc-3a11-4ba4-8635-da0817c1ab40', 'content-type': 'application/x-amz-json-1.1', 'content-length': '1747', 'date': 'Fri, 24 Sep 2021 19:55:48 GMT'}, 'RetryAttempts': 0}
+fake_tag_event = {'EventId': '058b6e28-fc6b-4e24-999d-3688423c9f43', 'EventName': 'CreateTags', 'ReadOnly': 'false', 'AccessKeyId': 'ACCESSKEYAWSUSER', 'EventTime': datetime(2021, 9, 24, 11, 16, 39, tzinfo=timezone.utc), 'EventSource': 'ec2.amazonaws.com', 'Username': 'Tagging-Role', 'Resources': [{'ResourceName': 'vol-02e6465799de7075a'}], 'CloudTrailEvent': '{"eventVersion":"1.08","userIdentity":{"type":"AssumedRole","principalId":"ACCESSKEYAWSUSER:Tagging-Role","arn":"arn:aws:sts::000000000000:assumed-role/Tagging-Role/Tagging-Role","accountId":"000000000000","accessKeyId":"ACCESSKEYAWSUSER","sessionContext":{"sessionIssuer":{"type":"Role","principalId":"ACCESSKEYAWSUSER","arn":"arn:aws:iam::000000000000:role/Tagging-Role","accountId":"000000000000","userName":"Tagging-Role"},"webIdFederationData":{},"attributes":{"creationDate":"2021-09-24T10:52:26Z","mfaAuthenticated":"false"}}},"eventTime":"2021-09-24T11:16:39Z","eventSource":"ec2.amazonaws.com","eventName":"CreateTags","awsRegion":"us-east-1","sourceIPAddress":"192.168.1.2","userAgent":"Boto3/1.17.100 Python/3.6.14 Linux/4.14.243-194.434.amzn2.x86_64 exec-env/AWS_Lambda_python3.6 Botocore/1.20.112 Resource","requestParameters":{"resourcesSet":{"items":[{"resourceId":"vol-02e6465799de7075a"}]},"tagSet":{"items":[{"key":"MyTag/Name","value":"super-cool-value"}]}},"responseElements":{"requestId":"c6ba9477-de04-4139-ae02-d2067a439a23","_return":true},"requestID":"c6ba9477-de04-4139-ae02-d2067a439a23","eventID":"058b6e28-fc6b-4e24-999d-3688423c9f43","readOnly":false,"eventType":"AwsApiCall","managementEvent":true,"recipientAccountId":"000000000000","eventCategory":"Management"}'}
+fake_attach_event = {'EventId': 'c51f115c-8ff0-4cc1-9221-beb548c96319', 'EventName': 'AttachVolume', 'ReadOnly': 'false', 'AccessKeyId': 'ACCESSKEYAWSUSER', 'EventTime': datetime(2021, 9, 24, 11, 16, 34, tzinfo=timezone.utc), 'EventSource': 'ec2.amazonaws.com', 'Username': 'i-0d4afab1261582ea4', 'Resources': [{'ResourceType': 'AWS::EC2::Volume', 'ResourceName': 'vol-02e6465799de7075a'}, {'ResourceType': 'AWS::EC2::Instance', 'ResourceName': 'i-00a057f697c421b81'}], 'CloudTrailEvent': '{"eventVersion":"1.08","userIdentity":{"type":"AssumedRole","principalId":"ACCESSKEYAWSUSER:i-0d4afab1261582ea4","arn":"arn:aws:sts::000000000000:assumed-role/instance-profile/i-0d4afab1261582ea4","accountId":"000000000000","accessKeyId":"ACCESSKEYAWSUSER","sessionContext":{"sessionIssuer":{"type":"Role","principalId":"ACCESSKEYAWSUSER","arn":"arn:aws:iam::000000000000:role/instance-profile","accountId":"000000000000","userName":"instance-profile"},"webIdFederationData":{},"attributes":{"creationDate":"2021-09-24T08:03:19Z","mfaAuthenticated":"false"},"ec2RoleDelivery":"2.0"}},"eventTime":"2021-09-24T11:16:34Z","eventSource":"ec2.amazonaws.com","eventName":"AttachVolume","awsRegion":"us-east-1","sourceIPAddress":"192.168.1.2","userAgent":"kubernetes/v1.18.18 aws-sdk-go/1.28.2 (go1.13.15; linux; amd64)","requestParameters":{"volumeId":"vol-02e6465799de7075a","instanceId":"i-00a057f697c421b81","device":"/dev/xvdcj","deleteOnTermination":false},"responseElements":{"requestId":"a954674c-98cd-4540-bcec-0094f50016d8","volumeId":"vol-02e6465799de7075a","instanceId":"i-00a057f697c421b81","device":"/dev/xvdcj","status":"attaching","attachTime":1632482194610,"deleteOnTermination":false},"requestID":"a954674c-98cd-4540-bcec-0094f50016d8","eventID":"c51f115c-8ff0-4cc1-9221-beb548c96319","readOnly":false,"eventType":"AwsApiCall","managementEvent":true,"recipientAccountId":"000000000000","eventCategory":"Management"}'}
+fake_detatch_event = {'EventId': '5bd736e8-ea6c-4a0f-9379-4626a40690cb', 'EventName': 'DetachVolume', 'ReadOnly': 'false', 'AccessKeyId': 'ACCESSKEYAWSUSER', 'EventTime': datetime(2021, 9, 24, 11, 16, 27, tzinfo=timezone.utc), 'EventSource': 'ec2.amazonaws.com', 'Username': 'i-0d4afab1261582ea4', 'Resources': [{'ResourceType': 'AWS::EC2::Volume', 'ResourceName': 'vol-02e6465799de7075a'}, {'ResourceType': 'AWS::EC2::Instance', 'ResourceName': 'i-01cc30b73e6aa39e7'}], 'CloudTrailEvent': '{"eventVersion":"1.08","userIdentity":{"type":"AssumedRole","principalId":"ACCESSKEYAWSUSER:i-0d4afab1261582ea4","arn":"arn:aws:sts::000000000000:assumed-role/instance-profile/i-0d4afab1261582ea4","accountId":"000000000000","accessKeyId":"ACCESSKEYAWSUSER","sessionContext":{"sessionIssuer":{"type":"Role","principalId":"ACCESSKEYAWSUSER","arn":"arn:aws:iam::000000000000:role/instance-profile","accountId":"000000000000","userName":"instance-profile"},"webIdFederationData":{},"attributes":{"creationDate":"2021-09-24T08:03:19Z","mfaAuthenticated":"false"},"ec2RoleDelivery":"2.0"}},"eventTime":"2021-09-24T11:16:27Z","eventSource":"ec2.amazonaws.com","eventName":"DetachVolume","awsRegion":"us-east-1","sourceIPAddress":"192.168.1.2","userAgent":"kubernetes/v1.18.18 aws-sdk-go/1.28.2 (go1.13.15; linux; amd64)","requestParameters":{"volumeId":"vol-02e6465799de7075a","instanceId":"i-01cc30b73e6aa39e7","force":false},"responseElements":{"requestId":"61831d71-9e87-47d6-b629-71de34a3fcd6","volumeId":"vol-02e6465799de7075a","instanceId":"i-01cc30b73e6aa39e7","device":"/dev/xvdba","status":"detaching","attachTime":1632334646000},"requestID":"61831d71-9e87-47d6-b629-71de34a3fcd6","eventID":"5bd736e8-ea6c-4a0f-9379-4626a40690cb","readOnly":false,"eventType":"AwsApiCall","managementEvent":true,"recipientAccountId":"000000000000","eventCategory":"Management"}'}
+fake_events = [fake_tag_event, fake_attach_event, fake_detatch_event]
+# the event each MockCloudtrail mode puts at the front of the list
+first_events = {'attach': fake_attach_event, 'detatch': fake_detatch_event}
 
 @pytest.fixture()
 def cloudtrail():
@@ -76,24 +164,34 @@ class MockCloudtrail():
     """Make calls to lookup_events return a DetachVolume event first."""
     self.mode = "detatch"
 
+  def get_paginator(self, operation_name):
+    """Return a fake paginator over lookup_events."""
+    return MockPaginator(self)
+
   def lookup_events(self, MaxResults, LookupAttributes=[]):
     """Return a fake response with MaxResults elements. The order is random
     unless a mode was specified."""
-    event_boilerplate = {
-      'NextToken': '2xx0x1Ec5ChGGwt/RvH4ii6HbkSpkxV0Fxy08nRjHkOV1FXMFZZm6W3/L+l7xz+o',
-      'ResponseMetadata': {'RequestId': 'c4fa7fcc-3a11-4ba4-8635-da0817c1ab40', 'HTTPStatusCode': 200, 'HTTPHeaders': {'x-amzn-requestid': 'c4fa7fcc-3a11-4ba4-8635-da0817c1ab40', 'content-type': 'application/x-amz-json-1.1', 'content-length': '1747', 'date': 'Fri, 24 Sep 2021 19:55:48 GMT'}, 'RetryAttempts': 0}
+    # one list of random fake events, exactly MaxResults long
+    events_rollup = choices(fake_events, k=MaxResults)
+    first_event = first_events.get(self.mode)
+    if first_event and events_rollup:
+      events_rollup[0] = first_event
+    return {
+      'NextToken': fake_next_token,
+      'ResponseMetadata': fake_response_metadata,
+      'Events': events_rollup,
     }
-    fake_tag_event = {'EventId': '058b6e28-fc6b-4e24-999d-3688423c9f43', 'EventName': 'CreateTags', 'ReadOnly': 'false', 'AccessKeyId': 'ACCESSKEYAWSUSER', 'EventTime': datetime(2021, 9, 24, 7, 16, 39, tzinfo=tzlocal()), 'EventSource': 'ec2.amazonaws.com', 'Username': 'Tagging-Role', 'Resources': [{'ResourceName': 'vol-02e6465799de7075a'}], 'CloudTrailEvent': '{"eventVersion":"1.08","userIdentity":{"type":"AssumedRole","principalId":"ACCESSKEYAWSUSER:Tagging-Role","arn":"arn:aws:sts::000000000000:assumed-role/Tagging-Role/Tagging-Role","accountId":"000000000000","accessKeyId":"ACCESSKEYAWSUSER","sessionContext":{"sessionIssuer":{"type":"Role","principalId":"ACCESSKEYAWSUSER","arn":"arn:aws:iam::000000000000:role/Tagging-Role","accountId":"000000000000","userName":"Tagging-Role"},"webIdFederationData":{},"attributes":{"creationDate":"2021-09-24T10:52:26Z","mfaAuthenticated":"false"}}},"eventTime":"2021-09-24T11:16:39Z","eventSource":"ec2.amazonaws.com","eventName":"CreateTags","awsRegion":"us-east-1","sourceIPAddress":"192.168.1.2","userAgent":"Boto3/1.17.100 Python/3.6.14 Linux/4.14.243-194.434.amzn2.x86_64 exec-env/AWS_Lambda_python3.6 Botocore/1.20.112 Resource","requestParameters":{"resourcesSet":{"items":[{"resourceId":"vol-02e6465799de7075a"}]},"tagSet":{"items":[{"key":"MyTag/Name","value":"super-cool-value"}]}},"responseElements":{"requestId":"c6ba9477-de04-4139-ae02-d2067a439a23","_return":true},"requestID":"c6ba9477-de04-4139-ae02-d2067a439a23","eventID":"058b6e28-fc6b-4e24-999d-3688423c9f43","readOnly":false,"eventType":"AwsApiCall","managementEvent":true,"recipientAccountId":"000000000000","eventCategory":"Management"}'}
-    fake_attach_event = {'EventId': 'c51f115c-8ff0-4cc1-9221-beb548c96319', 'EventName': 'AttachVolume', 'ReadOnly': 'false', 'AccessKeyId': 'ACCESSKEYAWSUSER', 'EventTime': datetime(2021, 9, 24, 7, 16, 34, tzinfo=tzlocal()), 'EventSource': 'ec2.amazonaws.com', 'Username': 'i-0d4afab1261582ea4', 'Resources': [{'ResourceType': 'AWS::EC2::Volume', 'ResourceName': 'vol-02e6465799de7075a'}, {'ResourceType': 'AWS::EC2::Instance', 'ResourceName': 'i-00a057f697c421b81'}], 'CloudTrailEvent': '{"eventVersion":"1.08","userIdentity":{"type":"AssumedRole","principalId":"ACCESSKEYAWSUSER:i-0d4afab1261582ea4","arn":"arn:aws:sts::000000000000:assumed-role/instance-profile/i-0d4afab1261582ea4","accountId":"000000000000","accessKeyId":"ACCESSKEYAWSUSER","sessionContext":{"sessionIssuer":{"type":"Role","principalId":"ACCESSKEYAWSUSER","arn":"arn:aws:iam::000000000000:role/instance-profile","accountId":"000000000000","userName":"instance-profile"},"webIdFederationData":{},"attributes":{"creationDate":"2021-09-24T08:03:19Z","mfaAuthenticated":"false"},"ec2RoleDelivery":"2.0"}},"eventTime":"2021-09-24T11:16:34Z","eventSource":"ec2.amazonaws.com","eventName":"AttachVolume","awsRegion":"us-east-1","sourceIPAddress":"192.168.1.2","userAgent":"kubernetes/v1.18.18 aws-sdk-go/1.28.2 (go1.13.15; linux; amd64)","requestParameters":{"volumeId":"vol-02e6465799de7075a","instanceId":"i-00a057f697c421b81","device":"/dev/xvdcj","deleteOnTermination":false},"responseElements":{"requestId":"a954674c-98cd-4540-bcec-0094f50016d8","volumeId":"vol-02e6465799de7075a","instanceId":"i-00a057f697c421b81","device":"/dev/xvdcj","status":"attaching","attachTime":1632482194610,"deleteOnTermination":false},"requestID":"a954674c-98cd-4540-bcec-0094f50016d8","eventID":"c51f115c-8ff0-4cc1-9221-beb548c96319","readOnly":false,"eventType":"AwsApiCall","managementEvent":true,"recipientAccountId":"000000000000","eventCategory":"Management"}'}
-    fake_detatch_event = {'EventId': '5bd736e8-ea6c-4a0f-9379-4626a40690cb', 'EventName': 'DetachVolume', 'ReadOnly': 'false', 'AccessKeyId': 'ACCESSKEYAWSUSER', 'EventTime': datetime(2021, 9, 24, 7, 16, 27, tzinfo=tzlocal()), 'EventSource': 'ec2.amazonaws.com', 'Username': 'i-0d4afab1261582ea4', 'Resources': [{'ResourceType': 'AWS::EC2::Volume', 'ResourceName': 'vol-02e6465799de7075a'}, {'ResourceType': 'AWS::EC2::Instance', 'ResourceName': 'i-01cc30b73e6aa39e7'}], 'CloudTrailEvent': '{"eventVersion":"1.08","userIdentity":{"type":"AssumedRole","principalId":"ACCESSKEYAWSUSER:i-0d4afab1261582ea4","arn":"arn:aws:sts::000000000000:assumed-role/instance-profile/i-0d4afab1261582ea4","accountId":"000000000000","accessKeyId":"ACCESSKEYAWSUSER","sessionContext":{"sessionIssuer":{"type":"Role","principalId":"ACCESSKEYAWSUSER","arn":"arn:aws:iam::000000000000:role/instance-profile","accountId":"000000000000","userName":"instance-profile"},"webIdFederationData":{},"attributes":{"creationDate":"2021-09-24T08:03:19Z","mfaAuthenticated":"false"},"ec2RoleDelivery":"2.0"}},"eventTime":"2021-09-24T11:16:27Z","eventSource":"ec2.amazonaws.com","eventName":"DetachVolume","awsRegion":"us-east-1","sourceIPAddress":"192.168.1.2","userAgent":"kubernetes/v1.18.18 aws-sdk-go/1.28.2 (go1.13.15; linux; amd64)","requestParameters":{"volumeId":"vol-02e6465799de7075a","instanceId":"i-01cc30b73e6aa39e7","force":false},"responseElements":{"requestId":"61831d71-9e87-47d6-b629-71de34a3fcd6","volumeId":"vol-02e6465799de7075a","instanceId":"i-01cc30b73e6aa39e7","device":"/dev/xvdba","status":"detaching","attachTime":1632334646000},"requestID":"61831d71-9e87-47d6-b629-71de34a3fcd6","eventID":"5bd736e8-ea6c-4a0f-9379-4626a40690cb","readOnly":false,"eventType":"AwsApiCall","managementEvent":true,"recipientAccountId":"000000000000","eventCategory":"Management"}'}
-    fake_events = [fake_tag_event, fake_attach_event, fake_detatch_event]
-    events_rollup = []
-    if self.mode == "attach":
-      events_rollup.append(fake_attach_event)
-    elif self.mode == "detatch":
-      events_rollup.append(fake_detatch_event)
-    while len(events_rollup) < MaxResults:
-      # add random fake events to the list
-      events_rollup.append(fake_events[randint(0, len(fake_events)-1)])
-    event_boilerplate['Events'] = events_rollup
-    return event_boilerplate
+
+class MockPaginator():
+  """Pages through MockCloudtrail.lookup_events, the way boto3's paginator
+  would."""
+  def __init__(self, cloudtrail):
+    self.cloudtrail = cloudtrail
+
+  def paginate(self, LookupAttributes=[], PaginationConfig={}):
+    """Yield pages of PageSize events until MaxItems have been returned."""
+    page_size = PaginationConfig.get('PageSize', 50)
+    max_items = PaginationConfig.get('MaxItems', page_size)
+    lookup_events = self.cloudtrail.lookup_events
+    for _ in range(0, max_items, page_size):
+      yield lookup_events(MaxResults=page_size, LookupAttributes=LookupAttributes)
@@ -1,76 +1,345 @@
 import logging
 import pytest
 import re
+import threading
+import time
 from datetime import timedelta
 from unittest.mock import MagicMock
 
+# a size in whole gibibytes, like the sts fixture's
+gi_size = re.compile('^[0-9]+Gi$')
 
-def test_delete_if_needed(operator_pvc_manager, v1, appsv1, pvc):
-  operator_pvc_manager.v1 = v1
-  operator_pvc_manager.appsv1 = appsv1
-  operator_pvc_manager.get_sts_for_pvc = MagicMock()
-  operator_pvc_manager.pvc_unmounted_long_enough = MagicMock()
-  sts_0_replicas = MagicMock()
-  sts_0_replicas.spec.replicas = 0
-
-  # recently deleted sts should not delete
-  operator_pvc_manager.get_sts_for_pvc.return_value = None
-  operator_pvc_manager.pvc_unmounted_long_enough.return_value = False
-  assert operator_pvc_manager.delete_if_needed(pvc) == False
-  operator_pvc_manager.v1.delete_namespaced_persistent_volume_claim.assert_not_called()
-
-  # recently downscaled sts should not delete
-  operator_pvc_manager.get_sts_for_pvc.return_value = sts_0_replicas
-  operator_pvc_manager.pvc_unmounted_long_enough.return_value = False
-  assert operator_pvc_manager.delete_if_needed(pvc) == False
-  operator_pvc_manager.v1.delete_namespaced_persistent_volume_claim.assert_not_called()
-
-  # long-deleted sts should delete
-  operator_pvc_manager.get_sts_for_pvc.return_value = None
-  operator_pvc_manager.pvc_unmounted_long_enough.return_value = True
-  assert operator_pvc_manager.delete_if_needed(pvc) == True
-  assert operator_pvc_manager.v1.delete_namespaced_persistent_volume_claim.call_count == 1
-
-  # long-downscaled sts should delete
-  operator_pvc_manager.get_sts_for_pvc.return_value = sts_0_replicas
-  operator_pvc_manager.pvc_unmounted_long_enough.return_value = True
-  assert operator_pvc_manager.delete_if_needed(pvc) == True
-  assert operator_pvc_manager.v1.delete_namespaced_persistent_volume_claim.call_count == 2
-
-def test_resize_if_needed(operator_pvc_manager, v1, appsv1, pvc):
-  operator_pvc_manager.v1 = v1
-  operator_pvc_manager.appsv1 = appsv1
-
-  # invalid units should return false
-  pvc.spec.resources.requests = {'storage':'40Ti'}  # we only accept Gi units
-  assert operator_pvc_manager.resize_if_needed(pvc) == False
-
-  # unspecified units should return false
-  operator_pvc_manager.get_pvc_desired_size = MagicMock()
-  operator_pvc_manager.get_pvc_desired_size.return_value = '12345'
-  assert operator_pvc_manager.resize_if_needed(pvc) == False
+
+def test_buffered_file_handler(operator_pvc_manager, tmpdir):
+  log_file = f"{tmpdir}/operator.log"
+  handler = operator_pvc_manager.BufferedFileHandler(log_file, flush_interval=3600)
+  test_logger = logging.getLogger('test_buffered_file_handler')
+  test_logger.addHandler(handler)
+  test_logger.setLevel(logging.INFO)
+  # info is held in the buffer
+  test_logger.info('first')
+  with open(log_file) as f:
+    assert f.read() == ''
+  # a warning flushes everything so far
+  test_logger.warning('second')
+  with open(log_file) as f:
+    assert f.read() == 'first\nsecond\n'
+  test_logger.removeHandler(handler)
+  # closing stops the flush thread
+  handler.close()
+  handler._flusher.join(timeout=5)
+  assert not handler._flusher.is_alive()
+
+  # closing while holding the lock, like logging.shutdown does, shouldn't
+  # deadlock with a flush thread that's waiting on the lock
+  handler = operator_pvc_manager.BufferedFileHandler(log_file, flush_interval=0.01)
+  def shutdown_like_logging():
+    handler.acquire()
+    try:
+      time.sleep(0.1)  # let the flush thread block on the lock
+      handler.flush()
+      handler.close()
+    finally:
+      handler.release()
+  closer = threading.Thread(target=shutdown_like_logging, daemon=True)
+  closer.start()
+  closer.join(timeout=5)
+  assert not closer.is_alive()
+  handler._flusher.join(timeout=5)
+  assert not handler._flusher.is_alive()
+
+def test_rate_limiter(operator_pvc_manager):
+  limiter = operator_pvc_manager.RateLimiter(20)
+  start = time.monotonic()
+  for _ in range(3):
+    limiter.wait()
+  # the first call goes straight through, the next two wait 1/20s each
+  assert time.monotonic() - start >= 0.1
+
+def test_reflector_list(operator_pvc_manager, make_pvc, pvc):
+  # two pages, linked by a continue token
+  page1 = MagicMock()
+  page1.items = [pvc]
+  page1.metadata._continue = 'next-page'
+  other_pvc = make_pvc(name='other-pvc')
+  page2 = MagicMock()
+  page2.items = [other_pvc]
+  page2.metadata._continue = None
+  page2.metadata.resource_version = '1234'
+  list_func = MagicMock(side_effect=[page1, page2])
+
+  reflector = operator_pvc_manager.Reflector(list_func, label_selector='pvc-operator/managed=true')
+  reflector.list()
+  assert list_func.call_count == 2
+  # every page carries the label selector
+  for call in list_func.call_args_list:
+    assert call.kwargs['label_selector'] == 'pvc-operator/managed=true'
+  # the first page comes from the watch cache
+  first_page_kwargs = list_func.call_args_list[0].kwargs
+  assert first_page_kwargs['resource_version'] == '0'
+  assert first_page_kwargs['resource_version_match'] == 'NotOlderThan'
+  # later pages only pass the continue token
+  assert list_func.call_args.kwargs['_continue'] == 'next-page'
+  assert 'resource_version' not in list_func.call_args.kwargs
+  assert reflector._rv == '1234'
+  assert len(reflector.items()) == 2
+
+def test_reflector_get(operator_pvc_manager, sts):
+  reflector = operator_pvc_manager.Reflector(MagicMock())
+  reflector._store[('default', 'some-sts')] = sts
+  assert reflector.get('default', 'some-sts') == sts
+  assert reflector.get('default', 'missing-sts') is None
+
+def test_reflector_by_index(operator_pvc_manager, make_pvc, pvc):
+  index_func = lambda obj: obj.metadata.annotations.get('pvc-operator/statefulset')
+  reflector = operator_pvc_manager.Reflector(MagicMock(), index_func=index_func)
+  reflector._add(pvc)
+  assert reflector.by_index('some-sts') == [pvc]
+  # an object that moves is re-indexed
+  moved_pvc = make_pvc(statefulset='other-sts')
+  reflector._add(moved_pvc)
+  assert reflector.by_index('some-sts') == []
+  assert reflector.by_index('other-sts') == [moved_pvc]
+  # a removed object leaves the index
+  reflector._remove((pvc.metadata.namespace, pvc.metadata.name))
+  assert reflector.by_index('other-sts') == []
+  assert reflector._index == {}
+
+def test_reflector_watch(operator_pvc_manager, monkeypatch, make_pvc, pvc):
+  pvc.metadata.resource_version = '1235'
+  gone_pvc = make_pvc(name='gone-pvc')
+  gone_pvc.metadata.resource_version = '1236'
+  monkeypatch.setattr(operator_pvc_manager, 'watch', MagicMock())
+  operator_pvc_manager.watch.Watch.return_value.stream.return_value = [
+    {'type': 'ADDED', 'object': pvc},
+    {'type': 'ADDED', 'object': gone_pvc},
+    {'type': 'DELETED', 'object': gone_pvc},
+    {'type': 'BOOKMARK', 'object': {'metadata': {'resourceVersion': '1240'}}},
+  ]
+
+  on_event = MagicMock()
+  reflector = operator_pvc_manager.Reflector(MagicMock(), on_event=on_event)
+  reflector._rv = '1234'
+  reflector.watch()
+  assert reflector.items() == [pvc]
+  assert reflector._rv == '1240'
+  # the client gives up on a watch a while after the apiserver should have
+  stream_kwargs = operator_pvc_manager.watch.Watch.return_value.stream.call_args.kwargs
+  assert stream_kwargs['_request_timeout'] > stream_kwargs['timeout_seconds']
+  # no label selector is sent unless one was given
+  assert 'label_selector' not in operator_pvc_manager.watch.Watch.return_value.stream.call_args.kwargs
+  # bookmarks aren't passed along to on_event
+  assert on_event.call_count == 3
+  on_event.assert_called_with('DELETED', gone_pvc)
+
+def test_main(operator_pvc_manager, monkeypatch, pvc):
+  monkeypatch.setattr(operator_pvc_manager, 'pvc_cache', MagicMock())
+  operator_pvc_manager.pvc_cache.get.return_value = pvc
+  monkeypatch.setattr(operator_pvc_manager, 'sts_cache', MagicMock())
+  monkeypatch.setattr(operator_pvc_manager, 'pv_cache', MagicMock())
+  monkeypatch.setattr(operator_pvc_manager, 'sweep', MagicMock())
+  monkeypatch.setattr(operator_pvc_manager, 'health_check', MagicMock())
+  # shut down as soon as the last queued pvc has been processed
+  def process_pvc(pvc):
+    if operator_pvc_manager.work_queue.empty():
+      operator_pvc_manager.request_shutdown()
+  monkeypatch.setattr(operator_pvc_manager, 'process_pvc', MagicMock(side_effect=process_pvc))
+  for _ in range(3):
+    operator_pvc_manager.work_queue.put(('default', 'some-sts-storage-12'))
+  operator_pvc_manager.main()
+  operator_pvc_manager.pvc_cache.start.assert_called_once()
+  operator_pvc_manager.sweep.assert_called_once()
+  assert operator_pvc_manager.process_pvc.call_count == 3
+  operator_pvc_manager.process_pvc.assert_called_with(pvc)
+  # a burst of events doesn't rewrite the heartbeat for each one
+  operator_pvc_manager.health_check.assert_called_once()
+
+def test_request_shutdown(operator_pvc_manager):
+  operator_pvc_manager.request_shutdown()
+  assert operator_pvc_manager.shutdown.is_set()
+  # main() is woken up to notice
+  assert operator_pvc_manager.work_queue.get_nowait() is None
+
+def test_sweep(operator_pvc_manager, monkeypatch, make_pvc, pvc):
+  unmanaged_pvc = make_pvc(statefulset=None)
+  unannotated_pvc = make_pvc(statefulset=None)
+  unannotated_pvc.metadata.annotations = None
+  monkeypatch.setattr(operator_pvc_manager, 'pvc_cache', MagicMock())
+  operator_pvc_manager.pvc_cache.items.return_value = [pvc, unmanaged_pvc, unannotated_pvc]
+  monkeypatch.setattr(operator_pvc_manager, 'is_orphaned', MagicMock(return_value=True))
+  monkeypatch.setattr(operator_pvc_manager, 'prefetch_attachment_events', MagicMock())
+  monkeypatch.setattr(operator_pvc_manager, 'process_pvc', MagicMock())
+  operator_pvc_manager.sweep()
+  # only managed pvcs are prefetched and processed
+  operator_pvc_manager.prefetch_attachment_events.assert_called_once_with([pvc])
+  operator_pvc_manager.process_pvc.assert_called_once_with(pvc)
+  # a shutdown stops the sweep
+  operator_pvc_manager.shutdown.set()
+  operator_pvc_manager.sweep()
+  operator_pvc_manager.process_pvc.assert_called_once_with(pvc)
+
+def test_sweep_concurrent(operator_pvc_manager, monkeypatch, make_pvc):
+  pvcs = [make_pvc(name='some-sts-storage-%s' % i) for i in range(8)]
+  monkeypatch.setattr(operator_pvc_manager, 'pvc_cache', MagicMock())
+  operator_pvc_manager.pvc_cache.items.return_value = pvcs
+  monkeypatch.setattr(operator_pvc_manager, 'is_orphaned', MagicMock(return_value=False))
+  # every pvc waits for all the others, which only works if they run at once
+  barrier = threading.Barrier(len(pvcs), timeout=5)
+  monkeypatch.setattr(operator_pvc_manager, 'process_pvc', MagicMock(side_effect=lambda pvc: barrier.wait()))
+  operator_pvc_manager.sweep()
+  assert operator_pvc_manager.process_pvc.call_count == 8
+
+def test_process_pvc(operator_pvc_manager, monkeypatch, sts_cache, sts, pvc):
+  monkeypatch.setattr(operator_pvc_manager, 'sts_cache', sts_cache)
+  monkeypatch.setattr(operator_pvc_manager, 'delete_if_needed', MagicMock())
+  monkeypatch.setattr(operator_pvc_manager, 'resize_if_needed', MagicMock())
+
+  # deleted pvc should not be resized
+  operator_pvc_manager.delete_if_needed.return_value = True
+  operator_pvc_manager.process_pvc(pvc)
+  operator_pvc_manager.resize_if_needed.assert_not_called()
+
+  # kept pvc should be resized
+  operator_pvc_manager.delete_if_needed.return_value = False
+  operator_pvc_manager.process_pvc(pvc)
+  operator_pvc_manager.resize_if_needed.assert_called_once_with(pvc, sts)
+
+  # unmanaged pvc should be left alone
+  pvc.metadata.annotations = {}
+  operator_pvc_manager.process_pvc(pvc)
+  assert operator_pvc_manager.delete_if_needed.call_count == 2
+
+  # even with no annotations at all
+  pvc.metadata.annotations = None
+  operator_pvc_manager.process_pvc(pvc)
+  assert operator_pvc_manager.delete_if_needed.call_count == 2
+
+def test_on_pvc_event(operator_pvc_manager, pvc):
+  operator_pvc_manager.on_pvc_event('MODIFIED', pvc)
+  assert operator_pvc_manager.work_queue.get_nowait() == ('default', 'some-sts-storage-12')
+  # a deleted pvc forgets its last patch
+  operator_pvc_manager.last_patched[('default', 'some-sts-storage-12')] = ('some-pvc-uid', '500Gi')
+  operator_pvc_manager.on_pvc_event('DELETED', pvc)
+  assert operator_pvc_manager.work_queue.empty()
+  assert operator_pvc_manager.last_patched == {}
+
+def test_forget_stale_patch(operator_pvc_manager, make_pvc):
+  key = ('default', 'some-sts-storage-12')
+  # a pvc that hasn't caught up with its patch keeps it
+  operator_pvc_manager.last_patched[key] = ('some-pvc-uid', '1Ti')
+  operator_pvc_manager.forget_stale_patch(make_pvc(size='500Gi'))
+  assert key in operator_pvc_manager.last_patched
+  # a pvc that has caught up forgets it
+  operator_pvc_manager.forget_stale_patch(make_pvc(size='1024Gi'))
+  assert key not in operator_pvc_manager.last_patched
+  # a pvc recreated under the same name forgets it, even if it was missed
+  operator_pvc_manager.last_patched[key] = ('some-pvc-uid', '1Ti')
+  operator_pvc_manager.on_pvc_event('ADDED', make_pvc(size='500Gi', uid='new-pvc-uid'))
+  assert key not in operator_pvc_manager.last_patched
+
+def test_on_sts_event(operator_pvc_manager, monkeypatch, make_pvc, sts, pvc):
+  other_pvc = make_pvc(name='other-pvc', statefulset='other-sts')
+  monkeypatch.setattr(operator_pvc_manager, 'pvc_cache', operator_pvc_manager.Reflector(MagicMock(), index_func=operator_pvc_manager.sts_key_for_pvc))
+  operator_pvc_manager.pvc_cache._add(pvc)
+  operator_pvc_manager.pvc_cache._add(other_pvc)
+  operator_pvc_manager.on_sts_event('MODIFIED', sts)
+  assert operator_pvc_manager.work_queue.get_nowait() == ('default', 'some-sts-storage-12')
+  assert operator_pvc_manager.work_queue.empty()
+
+def test_sts_key_for_pvc(operator_pvc_manager, pvc):
+  assert operator_pvc_manager.sts_key_for_pvc(pvc) == ('default', 'some-sts')
+  pvc.metadata.annotations = None
+  assert operator_pvc_manager.sts_key_for_pvc(pvc) is None
+
+def test_on_pv_event(operator_pvc_manager, pv_cache):
+  pv = pv_cache.get(None, 'some-pv')
+  operator_pvc_manager.ct_cache['some-pv'] = ('DetachVolume', None, None)
+  # a changed pv queues its pvc
+  operator_pvc_manager.on_pv_event('MODIFIED', pv)
+  assert 'some-pv' in operator_pvc_manager.ct_cache
+  assert operator_pvc_manager.work_queue.get_nowait() == ('default', 'some-sts-storage-12')
+  # a deleted pv forgets its cloudtrail answer
+  operator_pvc_manager.on_pv_event('DELETED', pv)
+  assert 'some-pv' not in operator_pvc_manager.ct_cache
+  assert operator_pvc_manager.work_queue.empty()
+
+@pytest.mark.parametrize('replicas,unmounted_long_enough,deleted', [
+  (None, False, False),  # recently deleted sts should not delete
+  (0,    False, False),  # recently downscaled sts should not delete
+  (None, True,  True),   # long-deleted sts should delete
+  (0,    True,  True),   # long-downscaled sts should delete
+])
+def test_delete_if_needed(operator_pvc_manager, monkeypatch, v1, make_sts, pvc, replicas, unmounted_long_enough, deleted):
+  monkeypatch.setattr(operator_pvc_manager, 'v1', v1)
+  monkeypatch.setattr(operator_pvc_manager, 'pvc_unmounted_long_enough', MagicMock(return_value=unmounted_long_enough))
+  sts = None if replicas is None else make_sts(replicas=replicas)
+  assert operator_pvc_manager.delete_if_needed(pvc, sts) == deleted
+  assert operator_pvc_manager.v1.delete_namespaced_persistent_volume_claim.call_count == int(deleted)
+
+def test_is_orphaned(operator_pvc_manager, monkeypatch, sts_cache, sts, pvc):
+  monkeypatch.setattr(operator_pvc_manager, 'sts_cache', sts_cache)
+  # pvc-12 is orphaned by an sts with 12 replicas (ordinals 0-11)
+  sts.spec.replicas = 12
+  assert operator_pvc_manager.is_orphaned(pvc) == True
+  # but not by one with 13
+  sts.spec.replicas = 13
+  assert operator_pvc_manager.is_orphaned(pvc) == False
+  # a missing sts orphans its pvc
+  pvc.metadata.annotations['pvc-operator/statefulset'] = 'deleted-sts'
+  assert operator_pvc_manager.is_orphaned(pvc) == True
+
+def test_resize_if_needed(operator_pvc_manager, monkeypatch, v1, sts, pvc):
+  monkeypatch.setattr(operator_pvc_manager, 'v1', v1)
+
+  # a missing sts should return false
+  assert operator_pvc_manager.resize_if_needed(pvc, False) == False
+
+  # different units should be compared by size, 40Ti is larger than 500Gi
+  pvc.spec.resources.requests = {'storage':'40Ti'}
+  assert operator_pvc_manager.resize_if_needed(pvc, sts) == False
+
+  # the same size in different units should return false
+  monkeypatch.setattr(operator_pvc_manager, 'get_pvc_desired_size', MagicMock())
+  pvc.spec.resources.requests['storage'] = '1Ti'
+  operator_pvc_manager.get_pvc_desired_size.return_value = '1024Gi'
+  assert operator_pvc_manager.resize_if_needed(pvc, sts) == False
 
   # desired matching current should return false
   pvc.spec.resources.requests['storage'] = '40Gi'
   operator_pvc_manager.get_pvc_desired_size.return_value = '40Gi'
-  assert operator_pvc_manager.resize_if_needed(pvc) == False
+  assert operator_pvc_manager.resize_if_needed(pvc, sts) == False
 
   # current exceeding desired should return false
   pvc.spec.resources.requests['storage'] = '400Gi'
   operator_pvc_manager.get_pvc_desired_size.return_value = '40Gi'
-  assert operator_pvc_manager.resize_if_needed(pvc) == False
+  assert operator_pvc_manager.resize_if_needed(pvc, sts) == False
 
   # desired exceeding current should scale up
   pvc.spec.resources.requests['storage'] = '40Gi'
   operator_pvc_manager.get_pvc_desired_size.return_value = '500Gi'
-  assert operator_pvc_manager.resize_if_needed(pvc) == True
+  assert operator_pvc_manager.resize_if_needed(pvc, sts) == True
   operator_pvc_manager.v1.patch_namespaced_persistent_volume_claim.assert_called_once()
 
-def test_get_sts_for_pvc(operator_pvc_manager, appsv1, pvc):
-  operator_pvc_manager.appsv1 = appsv1
+  # desired exceeding current in different units should scale up too
+  pvc.spec.resources.requests['storage'] = '500Gi'
+  operator_pvc_manager.get_pvc_desired_size.return_value = '1Ti'
+  assert operator_pvc_manager.resize_if_needed(pvc, sts) == True
+  patch = operator_pvc_manager.v1.patch_namespaced_persistent_volume_claim.call_args.kwargs['body']
+  assert patch['spec']['resources']['requests']['storage'] == '1Ti'
+
+  # a stale pvc we've already patched shouldn't be patched again
+  assert operator_pvc_manager.resize_if_needed(pvc, sts) == False
+  assert operator_pvc_manager.v1.patch_namespaced_persistent_volume_claim.call_count == 2
+
+def test_get_sts_for_pvc(operator_pvc_manager, monkeypatch, sts_cache, pvc):
+  monkeypatch.setattr(operator_pvc_manager, 'sts_cache', sts_cache)
   sts = operator_pvc_manager.get_sts_for_pvc(pvc)
   assert sts.metadata.name == 'some-sts'
 
+  # a deleted sts should return False
+  pvc.metadata.annotations['pvc-operator/statefulset'] = 'deleted-sts'
+  assert operator_pvc_manager.get_sts_for_pvc(pvc) == False
+
 def test_get_ordinal(operator_pvc_manager):
   fake_object = MagicMock()
   fake_object.metadata.name = 'my-sts-pod-5'
@@ -85,7 +354,11 @@ def test_get_ordinal(operator_pvc_manager):
 def test_get_pvc_desired_size(operator_pvc_manager, sts):
   # it should pull the size from the object, with correct format
   size = operator_pvc_manager.get_pvc_desired_size(sts)
-  assert re.match('^[0-9]+Gi$', size)
+  assert gi_size.match(size)
+
+  # other units are fine too
+  sts.metadata.annotations['pvc-operator/storage-size'] = '1Ti'
+  assert operator_pvc_manager.get_pvc_desired_size(sts) == '1Ti'
 
   # unspecified units should raise a warning
   sts.metadata.annotations['pvc-operator/storage-size'] = '12345'
@@ -93,10 +366,25 @@ def test_get_pvc_desired_size(operator_pvc_manager, sts):
     operator_pvc_manager.get_pvc_desired_size(sts)
   assert excinfo.typename == 'RuntimeWarning'
 
-def test_pvc_unmounted_long_enough(operator_pvc_manager, v1, cloudtrail, pvc):
-  operator_pvc_manager.pvc_grace_minutes = timedelta(seconds=1)
-  operator_pvc_manager.cloudtrail = cloudtrail
-  operator_pvc_manager.v1 = v1
+  # a missing annotation should raise a warning, even with no annotations at all
+  sts.metadata.annotations = None
+  with pytest.raises(RuntimeWarning) as excinfo:
+    operator_pvc_manager.get_pvc_desired_size(sts)
+  assert excinfo.typename == 'RuntimeWarning'
+
+  # a value that isn't a quantity at all should raise a warning
+  sts.metadata.annotations = {}
+  sts.metadata.annotations['pvc-operator/storage-size'] = 'huge'
+  with pytest.raises(RuntimeWarning) as excinfo:
+    operator_pvc_manager.get_pvc_desired_size(sts)
+  assert excinfo.typename == 'RuntimeWarning'
+
+def test_pvc_unmounted_long_enough(operator_pvc_manager, monkeypatch, pv_cache, cloudtrail, pvc):
+  monkeypatch.setattr(operator_pvc_manager, 'pvc_grace_minutes', timedelta(seconds=1))
+  monkeypatch.setattr(operator_pvc_manager, 'cloudtrail', cloudtrail)
+  monkeypatch.setattr(operator_pvc_manager, 'pv_cache', pv_cache)
+  # disable the cloudtrail cache so every scenario asks cloudtrail
+  monkeypatch.setattr(operator_pvc_manager, 'ct_cache_ttl', timedelta(0))
   # still attached, should return False
   operator_pvc_manager.cloudtrail.attach_first()
   long_enough = operator_pvc_manager.pvc_unmounted_long_enough(pvc)
@@ -106,46 +394,135 @@ def test_pvc_unmounted_long_enough(operator_pvc_manager, v1, cloudtrail, pvc):
   long_enough = operator_pvc_manager.pvc_unmounted_long_enough(pvc)
   assert long_enough == True
   # detatched "recently" (within grace period), should return False
-  operator_pvc_manager.pvc_grace_minutes = timedelta(days=10000)
+  monkeypatch.setattr(operator_pvc_manager, 'pvc_grace_minutes', timedelta(days=10000))
   operator_pvc_manager.cloudtrail.detatch_first()
   long_enough = operator_pvc_manager.pvc_unmounted_long_enough(pvc)
   assert long_enough == False
+  # a recent answer is reused instead of asking cloudtrail again
+  monkeypatch.setattr(operator_pvc_manager, 'ct_cache_ttl', timedelta(minutes=5))
+  monkeypatch.setattr(operator_pvc_manager, 'pvc_grace_minutes', timedelta(seconds=1))
+  monkeypatch.setattr(operator_pvc_manager, 'cloudtrail', MagicMock())
+  long_enough = operator_pvc_manager.pvc_unmounted_long_enough(pvc)
+  assert long_enough == True
+  operator_pvc_manager.cloudtrail.get_paginator.assert_not_called()
+
+def test_prefetch_attachment_events(operator_pvc_manager, monkeypatch, pv_cache, cloudtrail, make_pvc, pvc):
+  monkeypatch.setattr(operator_pvc_manager, 'cloudtrail', cloudtrail)
+  monkeypatch.setattr(operator_pvc_manager, 'pv_cache', pv_cache)
+  operator_pvc_manager.cloudtrail.detatch_first()
+  broken_pvc = make_pvc(name='broken-pvc', volume_name='missing-pv')
+  # a broken pvc shouldn't stop the others from being fetched
+  operator_pvc_manager.prefetch_attachment_events([broken_pvc, pvc])
+  assert operator_pvc_manager.ct_cache['some-pv'][0] == 'DetachVolume'
+  assert 'missing-pv' not in operator_pvc_manager.ct_cache
+  # after a shutdown, no more lookups are started
+  operator_pvc_manager.ct_cache.clear()
+  operator_pvc_manager.shutdown.set()
+  operator_pvc_manager.prefetch_attachment_events([pvc])
+  assert operator_pvc_manager.ct_cache == {}
+
+def test_get_cached_attachment_event(operator_pvc_manager, monkeypatch, pv_cache, cloudtrail):
+  monkeypatch.setattr(operator_pvc_manager, 'cloudtrail', cloudtrail)
+  monkeypatch.setattr(operator_pvc_manager, 'pv_cache', pv_cache)
+  operator_pvc_manager.cloudtrail.attach_first()
+  event_name, event_time = operator_pvc_manager.get_cached_attachment_event('some-pv')
+  assert event_name == 'AttachVolume'
+  # the second call is answered from the cache
+  monkeypatch.setattr(operator_pvc_manager, 'cloudtrail', MagicMock())
+  event_name, event_time = operator_pvc_manager.get_cached_attachment_event('some-pv')
+  assert event_name == 'AttachVolume'
+  operator_pvc_manager.cloudtrail.get_paginator.assert_not_called()
+  # an expired answer is looked up again
+  monkeypatch.setattr(operator_pvc_manager, 'ct_cache_ttl', timedelta(0))
+  monkeypatch.setattr(operator_pvc_manager, 'cloudtrail', cloudtrail)
+  operator_pvc_manager.cloudtrail.detatch_first()
+  event_name, event_time = operator_pvc_manager.get_cached_attachment_event('some-pv')
+  assert event_name == 'DetachVolume'
+
+def test_get_cached_attachment_event_concurrent(operator_pvc_manager, monkeypatch, pv_cache, cloudtrail):
+  monkeypatch.setattr(operator_pvc_manager, 'pv_cache', pv_cache)
+  # a slow cloudtrail, so that every thread misses the cache at once
+  lookup_events = cloudtrail.lookup_events
+  def slow_lookup_events(**kwargs):
+    time.sleep(0.1)
+    return lookup_events(**kwargs)
+  cloudtrail.detatch_first()
+  cloudtrail.lookup_events = MagicMock(side_effect=slow_lookup_events)
+  monkeypatch.setattr(operator_pvc_manager, 'cloudtrail', cloudtrail)
+  threads = [threading.Thread(target=operator_pvc_manager.get_cached_attachment_event, args=('some-pv',))
+             for _ in range(4)]
+  for thread in threads:
+    thread.start()
+  for thread in threads:
+    thread.join()
+  assert cloudtrail.lookup_events.call_count == 1
 
-def test_get_volume_id(operator_pvc_manager):
-  v1 = MagicMock()
-  operator_pvc_manager.v1 = v1
+def test_get_last_attachment_event(operator_pvc_manager, monkeypatch, cloudtrail, volume_id):
+  monkeypatch.setattr(operator_pvc_manager, 'cloudtrail', cloudtrail)
+  operator_pvc_manager.cloudtrail.attach_first()
+  event_name, event_time = operator_pvc_manager.get_last_attachment_event(volume_id)
+  assert event_name == 'AttachVolume'
+  operator_pvc_manager.cloudtrail.detatch_first()
+  event_name, event_time = operator_pvc_manager.get_last_attachment_event(volume_id)
+  assert event_name == 'DetachVolume'
+  # the first page has the answer, so no more pages are fetched
+  operator_pvc_manager.cloudtrail.lookup_events = MagicMock(wraps=operator_pvc_manager.cloudtrail.lookup_events)
+  operator_pvc_manager.get_last_attachment_event(volume_id)
+  assert operator_pvc_manager.cloudtrail.lookup_events.call_count == 1
+  # with nothing but tagging, every page is fetched and nothing is found
+  tags_only = MagicMock()
+  tags_only.get_paginator.return_value.paginate.return_value = [
+    {'Events': [{'EventName': 'CreateTags'}], 'NextToken': 'next-page'},
+    {'Events': [{'EventName': 'CreateTags'}]},
+  ]
+  monkeypatch.setattr(operator_pvc_manager, 'cloudtrail', tags_only)
+  monkeypatch.setattr(operator_pvc_manager, 'cloudtrail_limiter', MagicMock())
+  assert operator_pvc_manager.get_last_attachment_event(volume_id) == (None, None)
+  # only the two pages that were fetched spend the rate limit
+  assert operator_pvc_manager.cloudtrail_limiter.wait.call_count == 2
+  # and a lookup that runs out of pages doesn't wait for one more
+  monkeypatch.setattr(operator_pvc_manager, 'cloudtrail', cloudtrail)
+  operator_pvc_manager.cloudtrail.lookup_events = MagicMock(return_value={'Events': [], 'NextToken': 'next-page'})
+  operator_pvc_manager.cloudtrail_limiter.wait.reset_mock()
+  operator_pvc_manager.get_last_attachment_event(volume_id)
+  assert operator_pvc_manager.cloudtrail.lookup_events.call_count == 3
+  assert operator_pvc_manager.cloudtrail_limiter.wait.call_count == 3
+
+
+def test_get_volume_id(operator_pvc_manager, monkeypatch, make_pv, volume_id):
+  pv_cache = operator_pvc_manager.Reflector(MagicMock())
+  monkeypatch.setattr(operator_pvc_manager, 'pv_cache', pv_cache)
   # test gp2 spec
-  gp2 = MagicMock()
-  gp2.items[0].spec.aws_elastic_block_store.volume_id = 'aws://us-east-1c/vol-0a6d7a39a07212c42'
-  gp2.items[0].spec.csi = None
-  v1.list_persistent_volume.return_value = gp2
-  assert operator_pvc_manager.get_volume_id('some-pv') == 'vol-0a6d7a39a07212c42'
+  pv_cache._store[(None, 'some-pv')] = make_pv()
+  assert operator_pvc_manager.get_volume_id('some-pv') == volume_id
   # test gp3 spec
-  gp3 = MagicMock()
-  gp3.items[0].spec.csi.volume_handle = 'vol-0a6d7a39a07212c42'
-  gp3.items[0].spec.aws_elastic_block_store = None
-  v1.list_persistent_volume.return_value = gp3
-  assert operator_pvc_manager.get_volume_id('some-pv') == 'vol-0a6d7a39a07212c42'
+  pv_cache._store[(None, 'some-pv')] = make_pv(ebs_volume_id=None, csi_volume_handle=volume_id)
+  assert operator_pvc_manager.get_volume_id('some-pv') == volume_id
   # test missing volume
-  novol = MagicMock()
-  novol.items[0].spec.csi = None
-  novol.items[0].spec.aws_elastic_block_store = None
-  v1.list_persistent_volume.return_value = novol
+  pv_cache._store[(None, 'some-pv')] = make_pv(ebs_volume_id=None)
   with pytest.raises(RuntimeError) as excinfo:
     operator_pvc_manager.get_volume_id('some-pv')
   assert excinfo.typename == 'RuntimeError'
+  # test missing PV
+  with pytest.raises(RuntimeError) as excinfo:
+    operator_pvc_manager.get_volume_id('missing-pv')
+  assert excinfo.typename == 'RuntimeError'
 
-def test_ready_check(operator_pvc_manager, tmpdir, cloudtrail, v1, appsv1):
-  operator_pvc_manager.cloudtrail = cloudtrail
-  operator_pvc_manager.v1 = v1
-  operator_pvc_manager.appsv1 = appsv1
+def test_ready_check(operator_pvc_manager, monkeypatch, tmpdir, cloudtrail, v1, appsv1):
+  monkeypatch.setattr(operator_pvc_manager, 'cloudtrail', cloudtrail)
+  monkeypatch.setattr(operator_pvc_manager, 'v1', v1)
+  monkeypatch.setattr(operator_pvc_manager, 'appsv1', appsv1)
   check_file=f"{tmpdir}/heartbeat"
   operator_pvc_manager.ready_check(check_file=check_file)
   with open(check_file) as f:
-    assert f.readlines() == ['ready\n']
+    assert f.read() == 'ready\n'
+  # the permission probes only ask for a single object
+  operator_pvc_manager.v1.list_persistent_volume_claim_for_all_namespaces.assert_called_once_with(limit=1)
+  operator_pvc_manager.v1.list_persistent_volume.assert_called_once_with(limit=1)
+  operator_pvc_manager.appsv1.list_stateful_set_for_all_namespaces.assert_called_once_with(limit=1)
 
 def test_health_check(operator_pvc_manager, tmpdir):
   check_file=f"{tmpdir}/heartbeat"
   operator_pvc_manager.health_check(check_file=check_file)
   with open(check_file) as f:
-    assert f.readlines() == ['running\n']
+    assert f.read() == 'running\n'